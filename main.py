@@ -1,26 +1,47 @@
-from fastapi import FastAPI, Query, HTTPException, Depends
-from opensearchpy import OpenSearch
-from datetime import datetime
-from typing import Optional, List, Dict, Any
+from fastapi import FastAPI, Query, HTTPException, Depends, Header, Response, Path as PathParam
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from opensearchpy import AsyncOpenSearch, AsyncTransport
+from opensearchpy.serializer import JSONSerializer
+from opensearchpy.exceptions import NotFoundError, RequestError, TransportError
+from typing import Optional, List, Dict, Any, Tuple, AsyncIterator
+from collections import OrderedDict
 import configparser
 from pathlib import Path
 from dotenv import load_dotenv
 import os
 import logging
-from pydantic import BaseModel, validator
+import shutil
+import subprocess
+import sys
+import threading
+import urllib.request
+import time
+import asyncio
+import base64
+import hashlib
+import hmac
+import orjson
 
-# Adicionar importação para o pyngrok
-try:
-    from pyngrok import ngrok
-    ngrok_available = True
-except ImportError:
-    ngrok_available = False
-    print("Ngrok não está instalado. Execute 'pip install pyngrok' para habilitar o túnel Ngrok.")
+# Configuração do logging: uma linha JSON por registro
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry).decode("utf-8")
 
-# Configuração básica do logging
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(JSONFormatter())
+logging.basicConfig(level=logging.INFO, handlers=[_log_handler])
+log = logging.getLogger(__name__)
 
 app = FastAPI(
+    default_response_class=ORJSONResponse,
     title="Deviations API",
     description="""
 API para consultar desvios de câmeras armazenados no OpenSearch:
@@ -39,6 +60,11 @@ API para consultar desvios de câmeras armazenados no OpenSearch:
     - **GET /deviations**: Consulta desvios de câmeras com filtros opcionais.
     - **GET /deviations/{deviation_id}**: Consulta detalhes de um desvio específico pelo ID.
     - **GET /health**: Verifica o status da API e do cluster OpenSearch.
+    - **GET /health/live**: Verifica apenas se o processo da API está no ar (liveness).
+    - **GET /health/ready**: Verifica se a API e o OpenSearch estão prontos (readiness).
+    - **POST /cache/flush**: Limpa, em melhor esforço, o cache de resultados do worker que atender a requisição
+      (requer o cabeçalho `X-Admin-Token` igual a `CACHE_FLUSH_TOKEN`; o cache é por processo e,
+      nos demais workers, os resultados expiram em até 60 segundos).
 
 *  Exemplos de Uso:
     - **Filtrar desvios por nome da câmera:**
@@ -68,7 +94,8 @@ API para consultar desvios de câmeras armazenados no OpenSearch:
             "event_type": "motion_detected",
             "timestamp": "2023-10-01T12:34:56"
           }
-        ]
+        ],
+        "next_cursor": "WyIyMDIzLTEwLTAxVDEyOjM0OjU2IiwiYWJjMTIzIl0="
       }
       ```
     - **Detalhes de um desvio:**
@@ -92,12 +119,17 @@ API para consultar desvios de câmeras armazenados no OpenSearch:
     - **200**: Sucesso na requisição.
     - **400**: Parâmetros inválidos.
     - **404**: Desvio não encontrado.
+    - **422**: Parâmetros com formato inválido (ex.: ID do desvio).
     - **500**: Erro ao consultar o OpenSearch.
     - **503**: Serviço indisponível.
 
 * Configuração:
+    - **Execução**: `python main.py` inicia `2 * CPUs + 1` workers (ajustável via `WEB_CONCURRENCY`).
+      Em produção: `gunicorn main:app -k uvicorn.workers.UvicornWorker -w 9 -b 0.0.0.0:8000`.
     - **OpenSearch**: Certifique-se de que o arquivo `config.ini` e o arquivo `.env` estão configurados corretamente.
-    - **Ngrok**: Opcional para expor a API externamente. Instale com `pip install pyngrok`.
+      Para habilitar a busca concorrente em segmentos no índice (uma única vez): `python main.py enable-concurrent-segment-search`.
+    - **Ngrok**: Opcional para expor a API externamente. Instale o binário `ngrok` e defina `ENABLE_NGROK=1`
+      (domínio configurável via `NGROK_DOMAIN`).
 
 * Observações:
     - A API utiliza autenticação básica para acessar o OpenSearch.
@@ -123,44 +155,426 @@ load_dotenv()
 config = configparser.ConfigParser()
 config.read("config.ini")
 
+# Configurações lidas uma única vez na importação do módulo
+_OS_HOST = config["opensearch"]["host"]
+_OS_PORT = int(config["opensearch"]["port"])
+_OS_SSL = config["opensearch"].getboolean("use_ssl")
+_OS_VERIFY = config["opensearch"].getboolean("verify_certs")
+_OS_USER = os.getenv("OPENSEARCH_USERNAME")
+_OS_PASS = os.getenv("OPENSEARCH_PASSWORD")
+
+# Conexões HTTP por nó e timeout (segundos) de cada requisição ao OpenSearch
+_OS_POOL_MAXSIZE = 64
+_OS_TIMEOUT = 5
+
+# Serializador do OpenSearch baseado em orjson, mais rápido que o json da stdlib
+class ORJSONSerializer(JSONSerializer):
+    def dumps(self, data):
+        # Strings (ex.: corpo já serializado) são enviadas sem alteração
+        if isinstance(data, str):
+            return data
+        return orjson.dumps(data, default=self.default).decode("utf-8")
+
+    def loads(self, s):
+        return orjson.loads(s)
+
+# Transporte que conta todas as requisições em andamento (search, get, health, ping...),
+# pois todas disputam o mesmo pool de conexões. Registra apenas a entrada e a saída
+# da saturação, avaliadas no início e no fim de cada requisição
+class PoolTrackingTransport(AsyncTransport):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.inflight = 0
+        self._saturated = False
+
+    async def perform_request(self, *args, **kwargs):
+        self.inflight += 1
+        self._update_saturation()
+        try:
+            return await super().perform_request(*args, **kwargs)
+        finally:
+            self.inflight -= 1
+            self._update_saturation()
+
+    def _update_saturation(self):
+        # Acima disso, novas requisições ficam aguardando uma conexão livre no pool
+        saturated = self.inflight > _OS_POOL_MAXSIZE
+        if saturated and not self._saturated:
+            log.warning("Pool de conexões do OpenSearch saturado: %s requisições em andamento", self.inflight)
+        elif self._saturated and not saturated:
+            log.info("Pool de conexões do OpenSearch normalizado: %s requisições em andamento", self.inflight)
+        self._saturated = saturated
+
+# Agrupa buscas concorrentes em uma única chamada _msearch ao OpenSearch
+class MSearchBatcher:
+    def __init__(self, client: AsyncOpenSearch, index: str, max_batch_size: int = 32, window: float = 0.005):
+        self.client = client
+        self.index = index
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self._queue: "asyncio.Queue[Tuple[Dict[str, Any], asyncio.Future]]" = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: set = set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await asyncio.gather(*self._inflight, return_exceptions=True)
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Serviço encerrando"))
+
+    async def search(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((body, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            # Janela curta para acumular outras buscas que chegarem em seguida
+            try:
+                await asyncio.sleep(self.window)
+            except asyncio.CancelledError:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(RuntimeError("Serviço encerrando"))
+                raise
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            task = asyncio.create_task(self._dispatch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _dispatch(self, batch: List[Tuple[Dict[str, Any], asyncio.Future]]):
+        lines: List[Dict[str, Any]] = []
+        for body, _ in batch:
+            # request_cache: reutiliza o cache de requisições por shard do OpenSearch
+            lines.append({"index": self.index, "request_cache": True})
+            lines.append(body)
+        error: Exception = RuntimeError("Resposta do _msearch sem resultado para esta busca")
+        try:
+            response = await self.client.msearch(
+                body=lines,
+                # "status" garante uma entrada por busca, mesmo quando não há resultados
+                filter_path=["responses.status", "responses.error", "responses.hits.hits._source", "responses.hits.hits.sort"]
+            )
+            for (_, future), item in zip(batch, response["responses"]):
+                if future.done():
+                    continue
+                if "error" in item:
+                    # 400: busca rejeitada pelo OpenSearch (ex.: data impossível ou cursor incompatível)
+                    status = item.get("status", 500)
+                    error_class = RequestError if status == 400 else TransportError
+                    future.set_exception(error_class(status, item["error"].get("type"), item["error"]))
+                else:
+                    future.set_result(item)
+        except Exception as e:
+            error = e
+        finally:
+            # Nenhuma busca do lote pode ficar sem resposta (erro, resposta incompleta ou cancelamento)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+
+# Habilita a busca concorrente em segmentos no índice (OpenSearch 2.17+). É uma alteração
+# administrativa única, executada manualmente fora dos workers:
+#   python main.py enable-concurrent-segment-search
+# Não escreve nada se um operador já definiu o modo, no índice ou no cluster
+_CONCURRENT_SEGMENT_SEARCH_SETTING = "index.search.concurrent_segment_search.mode"
+_CLUSTER_CONCURRENT_SEGMENT_SEARCH_SETTINGS = (
+    "search.concurrent_segment_search.mode",
+    "search.concurrent_segment_search.enabled"
+)
+
+async def _enable_concurrent_segment_search(client: AsyncOpenSearch):
+    current = await client.indices.get_settings(
+        index="deviations",
+        name=_CONCURRENT_SEGMENT_SEARCH_SETTING,
+        flat_settings=True
+    )
+    if any(_CONCURRENT_SEGMENT_SEARCH_SETTING in index["settings"] for index in current.values()):
+        log.info("Concurrent segment search já definido no índice deviations; nada a fazer")
+        return
+
+    # Apenas valores definidos explicitamente (persistent/transient) representam a escolha de um
+    # operador; os defaults sempre trazem a chave em versões que suportam o recurso
+    cluster = await client.cluster.get_settings(flat_settings=True)
+    for scope in ("persistent", "transient"):
+        for name in _CLUSTER_CONCURRENT_SEGMENT_SEARCH_SETTINGS:
+            if name in cluster.get(scope, {}):
+                log.info("Concurrent segment search já definido no cluster (%s: %s); nada a fazer", scope, name)
+                return
+
+    await client.indices.put_settings(
+        index="deviations",
+        body={_CONCURRENT_SEGMENT_SEARCH_SETTING: "auto"}
+    )
+    log.info("Concurrent segment search habilitado no índice deviations")
+
 # OpenSearch configuration
-def get_opensearch_client():
-    client = OpenSearch(
-        hosts=[{"host": config["opensearch"]["host"], "port": int(config["opensearch"]["port"])}],
-        http_auth=(os.getenv("OPENSEARCH_USERNAME"), os.getenv("OPENSEARCH_PASSWORD")),
-        use_ssl=config["opensearch"].getboolean("use_ssl"),
-        verify_certs=config["opensearch"].getboolean("verify_certs")
+# Cliente compartilhado, criado uma única vez no startup da aplicação
+_client: Optional[AsyncOpenSearch] = None
+_batcher: Optional[MSearchBatcher] = None
+
+def _make_opensearch_client() -> AsyncOpenSearch:
+    return AsyncOpenSearch(
+        hosts=[{"host": _OS_HOST, "port": _OS_PORT}],
+        http_auth=(_OS_USER, _OS_PASS),
+        use_ssl=_OS_SSL,
+        verify_certs=_OS_VERIFY,
+        serializer=ORJSONSerializer(),
+        transport_class=PoolTrackingTransport,
+        maxsize=_OS_POOL_MAXSIZE,
+        timeout=_OS_TIMEOUT,
+        http_compress=True,
+        retry_on_timeout=True,
+        max_retries=2
     )
-    
-    # Verify OpenSearch connection
-    if not client.ping():
-        raise Exception("Não foi possível conectar ao OpenSearch!")
-    
-    return client
-
-# Modelo para validação dos parâmetros de consulta
-class DeviationQueryParams(BaseModel):
-    camera_name: Optional[str] = None
-    event_type: Optional[str] = None
-    camera_type: Optional[str] = None
-    start_time: Optional[datetime] = None
-    end_time: Optional[datetime] = None
-    size: int = 10
-    from_: int = 0
-
-    @validator("start_time", "end_time", pre=True)
-    def parse_datetime(cls, value):
-        if isinstance(value, str):
-            try:
-                return datetime.fromisoformat(value)
-            except ValueError:
-                raise ValueError("Formato de data inválido. Use o formato ISO 8601 (YYYY-MM-DDTHH:MM:SS).")
+
+@app.on_event("startup")
+async def startup_opensearch_client():
+    global _client, _batcher
+    _client = _make_opensearch_client()
+
+    # Verify OpenSearch connection; a API sobe mesmo assim e /health/ready reporta a indisponibilidade
+    try:
+        available = await _client.ping()
+    except Exception as e:
+        log.warning("Erro ao verificar a conexão com o OpenSearch: %s", e)
+        available = False
+    if not available:
+        log.warning("Não foi possível conectar ao OpenSearch no startup; as consultas falharão até que ele esteja disponível")
+
+    _batcher = MSearchBatcher(_client, index="deviations")
+    _batcher.start()
+
+@app.on_event("shutdown")
+async def shutdown_opensearch_client():
+    if _batcher is not None:
+        await _batcher.stop()
+    if _client is not None:
+        await _client.close()
+
+def get_opensearch_client() -> AsyncOpenSearch:
+    return _client
+
+def get_msearch_batcher() -> MSearchBatcher:
+    return _batcher
+
+# Build the OpenSearch query based on filters
+# O dicionário é montado diretamente: mais barato que copiar um template pré-serializado
+def _build_query(
+    camera_name: Optional[str],
+    event_type: Optional[str],
+    camera_type: Optional[str],
+    start_time: Optional[str],
+    end_time: Optional[str]
+) -> Dict[str, Any]:
+    # Filtros de igualdade/intervalo não precisam de score e podem ser cacheados pelo OpenSearch
+    filters = []
+
+    # Add filters to the query
+    if camera_name:
+        filters.append({"term": {"camera_name": camera_name}})
+
+    if event_type:
+        filters.append({"term": {"event_type": event_type}})
+
+    if camera_type:
+        filters.append({"term": {"camera_type": camera_type}})
+
+    # Add time range filter if start and/or end times are provided
+    if start_time and end_time:
+        filters.append({"range": {"timestamp": {"gte": start_time, "lte": end_time}}})
+    elif start_time:
+        filters.append({"range": {"timestamp": {"gte": start_time}}})
+    elif end_time:
+        filters.append({"range": {"timestamp": {"lte": end_time}}})
+
+    return {
+        "query": {"bool": {"filter": filters}},
+        "track_total_hits": False,
+        # Ordenação estável, necessária para a paginação com search_after
+        "sort": [{"timestamp": "asc"}, {"_id": "asc"}]
+    }
+
+# Cache LRU em memória com expiração (TTL) para os resultados do OpenSearch
+class TTLCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
         return value
 
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+_search_cache = TTLCache(maxsize=1024, ttl=60)
+_get_cache = TTLCache(maxsize=1024, ttl=60)
+
+# Cursor de paginação: valores de "sort" do último resultado, em JSON codificado em base64
+def _encode_cursor(sort_values: List[Any]) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps(sort_values)).decode("ascii")
+
+def _decode_cursor(cursor: str) -> Tuple:
+    try:
+        sort_values = orjson.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    # Um valor escalar por chave de ordenação (timestamp, _id)
+    if (
+        not isinstance(sort_values, list)
+        or len(sort_values) != 2
+        or not all(
+            value is None or (isinstance(value, (str, int, float)) and not isinstance(value, bool))
+            for value in sort_values
+        )
+    ):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    return tuple(sort_values)
+
+# key: (camera_name, event_type, camera_type, start_time, end_time, size, from_, search_after)
+# Retorna o resultado e o seu ETag, calculado uma única vez sobre o conteúdo serializado
+async def _cached_search(batcher: MSearchBatcher, key: Tuple) -> Tuple[Dict[str, Any], str]:
+    cached = _search_cache.get(key)
+    if cached is None:
+        camera_name, event_type, camera_type, start_time, end_time, size, from_, search_after = key
+        query = _build_query(camera_name, event_type, camera_type, start_time, end_time)
+        query["size"] = size
+        if search_after is not None:
+            query["search_after"] = list(search_after)
+        else:
+            query["from"] = from_
+        response = await batcher.search(query)
+        # Com filter_path, uma busca sem resultados não traz a chave "hits"
+        hits = response.get("hits", {}).get("hits", [])
+        result = {
+            "deviations": [hit["_source"] for hit in hits],
+            # Só há próxima página se a página atual veio completa
+            "next_cursor": _encode_cursor(hits[-1]["sort"]) if len(hits) == size else None
+        }
+        etag = '"' + hashlib.blake2b(orjson.dumps(result), digest_size=16).hexdigest() + '"'
+        cached = (result, etag)
+        _search_cache.set(key, cached)
+    return cached
+
+# Streaming em ndjson: percorre os resultados com search_after, um lote por vez,
+# sem materializar a lista completa em memória; limitado a _STREAM_MAX_ROWS linhas
+_STREAM_PAGE_SIZE = 500
+_STREAM_MAX_ROWS = 10000
+
+async def _stream_deviations(
+    batcher: MSearchBatcher,
+    query: Dict[str, Any],
+    hits: List[Dict[str, Any]]
+) -> AsyncIterator[bytes]:
+    # A primeira página já foi buscada pelo endpoint, antes do envio do status HTTP
+    sent = 0
+    try:
+        while True:
+            for hit in hits:
+                yield orjson.dumps(hit["_source"]) + b"\n"
+            sent += len(hits)
+            if len(hits) < query["size"] or sent >= _STREAM_MAX_ROWS:
+                return
+            query.pop("from", None)
+            query["search_after"] = hits[-1]["sort"]
+            query["size"] = min(_STREAM_PAGE_SIZE, _STREAM_MAX_ROWS - sent)
+            response = await batcher.search(query)
+            hits = response.get("hits", {}).get("hits", [])
+    except Exception as e:
+        # O status HTTP já foi enviado; registra o erro e interrompe a resposta,
+        # para que o cliente veja um stream truncado e não um fim normal
+        log.error("Erro ao consultar OpenSearch durante o streaming: %s", e)
+        raise
+
+# Negociação de conteúdo: ndjson só quando listado explicitamente com q > 0 e preferido ao JSON
+# (JSON é considerado pelo range mais específico: application/json, application/* ou */*)
+def _prefers_ndjson(accept: Optional[str]) -> bool:
+    if not accept:
+        return False
+    ranges: Dict[str, float] = {}
+    for part in accept.split(","):
+        media_type, *params = [item.strip() for item in part.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if media_type:
+            ranges[media_type.lower()] = q
+
+    ndjson_q = ranges.get("application/x-ndjson", 0.0)
+    if ndjson_q <= 0:
+        return False
+    if "application/json" in ranges:
+        # Empate com JSON explícito mantém o JSON, por compatibilidade
+        return ndjson_q > ranges["application/json"]
+    json_q = ranges.get("application/*", ranges.get("*/*", 0.0))
+    return ndjson_q >= json_q
+
+# Cabeçalhos HTTP de cache, para que um proxy reverso (nginx/Varnish) responda consultas repetidas.
+# Exemplo de nginx:
+#   proxy_cache_path /var/cache/nginx/deviations keys_zone=deviations:10m max_size=100m;
+#   location /deviations { proxy_cache deviations; proxy_cache_key $scheme$host$request_uri$http_accept; proxy_pass http://api; }
+# O corpo depende do cabeçalho Accept (JSON ou ndjson), por isso o Vary
+_CACHE_CONTROL = "public, max-age=30"
+_VARY = "Accept"
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+async def _cached_get(opensearch_client: AsyncOpenSearch, deviation_id: str) -> Dict[str, Any]:
+    deviation = _get_cache.get(deviation_id)
+    if deviation is None:
+        response = await opensearch_client.get(
+            index="deviations",
+            id=deviation_id,
+            filter_path=["_source"]
+        )
+        deviation = response["_source"]
+        _get_cache.set(deviation_id, deviation)
+    return deviation
+
+# Datas aceitas em /deviations, repassadas sem conversão ao filtro de intervalo
+_ISO_DATETIME_PATTERN = r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}$"
+
 # Endpoint to query deviations
 @app.get(
     "/deviations",
-    response_model=Dict[str, List[Dict[str, Any]]],
+    response_model=Dict[str, Any],
     summary="Consultar desvios de câmeras",
     description="""
     **Consulta desvios de câmeras com filtros opcionais.**
@@ -170,7 +584,9 @@ class DeviationQueryParams(BaseModel):
     ### Exemplo de Uso:
     - Filtrar por nome da câmera: `?camera_name=Camera_01`
     - Filtrar por intervalo de tempo: `?start_time=2023-10-01T00:00:00&end_time=2023-10-01T23:59:59`
-    - Paginação: `?size=20&from=10`
+    - Paginação: `?size=20`, depois `?size=20&cursor=<next_cursor>` para as páginas seguintes
+    - Paginação por deslocamento (obsoleta): `?size=20&from=10`
+    - Resultados em streaming: cabeçalho `Accept: application/x-ndjson` (um desvio JSON por linha, até 10000 linhas; `size` é ignorado)
 
     ### Resposta:
     ```json
@@ -181,97 +597,86 @@ class DeviationQueryParams(BaseModel):
           "event_type": "motion_detected",
           "timestamp": "2023-10-01T12:34:56"
         }
-      ]
+      ],
+      "next_cursor": "WyIyMDIzLTEwLTAxVDEyOjM0OjU2IiwiYWJjMTIzIl0="
     }
     ```
     """,
     responses={
-        200: {"description": "Lista de desvios encontrados"},
+        200: {
+            "description": "Lista de desvios encontrados",
+            "content": {"application/x-ndjson": {}}
+        },
+        304: {"description": "Resultado não modificado (If-None-Match corresponde ao ETag)"},
         400: {"description": "Parâmetros inválidos"},
         500: {"description": "Erro ao consultar o OpenSearch"}
     }
 )
-def get_deviations(
+async def get_deviations(
+    response: Response,
     camera_name: Optional[str] = Query(None, description="Filtrar por nome da câmera"),
     event_type: Optional[str] = Query(None, description="Filtrar por tipo de evento"),
     camera_type: Optional[str] = Query(None, description="Filtrar por tipo de câmera"),
-    start_time: Optional[datetime] = Query(None, description="Início do intervalo de tempo"),
-    end_time: Optional[datetime] = Query(None, description="Fim do intervalo de tempo"),
+    start_time: Optional[str] = Query(None, description="Início do intervalo de tempo (YYYY-MM-DDTHH:MM:SS)", pattern=_ISO_DATETIME_PATTERN),
+    end_time: Optional[str] = Query(None, description="Fim do intervalo de tempo (YYYY-MM-DDTHH:MM:SS)", pattern=_ISO_DATETIME_PATTERN),
     size: int = Query(10, description="Número de resultados por página", ge=1, le=100),
-    from_: int = Query(0, alias="from", description="Iniciar a partir do resultado"),
-    opensearch_client: OpenSearch = Depends(get_opensearch_client)
+    from_: int = Query(0, alias="from", description="Iniciar a partir do resultado (obsoleto, use cursor)", deprecated=True),
+    cursor: Optional[str] = Query(None, description="Cursor da próxima página (next_cursor da resposta anterior)"),
+    if_none_match: Optional[str] = Header(None, include_in_schema=False),
+    accept: Optional[str] = Header(None, include_in_schema=False),
+    batcher: MSearchBatcher = Depends(get_msearch_batcher)
 ):
     try:
-        # Validação dos parâmetros
-        query_params = DeviationQueryParams(
-            camera_name=camera_name,
-            event_type=event_type,
-            camera_type=camera_type,
-            start_time=start_time,
-            end_time=end_time,
-            size=size,
-            from_=from_
-        )
+        # Os parâmetros já chegam validados pelo FastAPI; no formato fixo
+        # YYYY-MM-DDTHH:MM:SS a comparação de strings equivale à de datas
+        if start_time and end_time and start_time > end_time:
+            raise HTTPException(status_code=400, detail="start_time deve ser anterior a end_time")
 
-        # Build the OpenSearch query based on filters
-        query = {"query": {"bool": {"must": []}}}
-        
-        # Add filters to the query
-        if query_params.camera_name:
-            query["query"]["bool"]["must"].append({"term": {"camera_name": query_params.camera_name}})
-        
-        if query_params.event_type:
-            query["query"]["bool"]["must"].append({"term": {"event_type": query_params.event_type}})
-            
-        if query_params.camera_type:
-            query["query"]["bool"]["must"].append({"term": {"camera_type": query_params.camera_type}})
-        
-        # Add time range filter if both start and end times are provided
-        if query_params.start_time and query_params.end_time:
-            if query_params.start_time > query_params.end_time:
-                raise HTTPException(status_code=400, detail="start_time deve ser anterior a end_time")
-                
-            query["query"]["bool"]["must"].append({
-                "range": {
-                    "timestamp": {
-                        "gte": query_params.start_time.isoformat(),
-                        "lte": query_params.end_time.isoformat()
-                    }
-                }
-            })
-        elif query_params.start_time:
-            query["query"]["bool"]["must"].append({
-                "range": {
-                    "timestamp": {
-                        "gte": query_params.start_time.isoformat()
-                    }
-                }
-            })
-        elif query_params.end_time:
-            query["query"]["bool"]["must"].append({
-                "range": {
-                    "timestamp": {
-                        "lte": query_params.end_time.isoformat()
-                    }
-                }
-            })
-        
-        # Execute the query in OpenSearch
-        response = opensearch_client.search(
-            index="deviations",
-            body=query,
-            size=query_params.size,
-            from_=query_params.from_
-        )
-        
-        # Return the results
-        deviations = [hit["_source"] for hit in response["hits"]["hits"]]
-        return {"deviations": deviations}
+        search_after = _decode_cursor(cursor) if cursor else None
+
+        # Opt-in via "Accept: application/x-ndjson": até _STREAM_MAX_ROWS resultados, um JSON por linha
+        if _prefers_ndjson(accept):
+            query = _build_query(camera_name, event_type, camera_type, start_time, end_time)
+            query["size"] = _STREAM_PAGE_SIZE
+            if search_after is not None:
+                query["search_after"] = list(search_after)
+            elif from_:
+                query["from"] = from_
+            # Falhas na primeira página ainda viram um status de erro, antes de iniciar o stream
+            first_page = await batcher.search(query)
+            hits = first_page.get("hits", {}).get("hits", [])
+            return StreamingResponse(
+                _stream_deviations(batcher, query, hits),
+                media_type="application/x-ndjson",
+                headers={"Vary": _VARY}
+            )
+
+        # Execute the query in OpenSearch (ou reutiliza o resultado em cache)
+        result, etag = await _cached_search(batcher, (
+            camera_name,
+            event_type,
+            camera_type,
+            start_time,
+            end_time,
+            size,
+            from_,
+            search_after
+        ))
+
+        headers = {"ETag": etag, "Cache-Control": _CACHE_CONTROL, "Vary": _VARY}
+        if _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+        response.headers.update(headers)
+        return result
     
     except HTTPException:
         raise
+    except RequestError as e:
+        # Valores aceitos pelo formato mas inválidos para o OpenSearch (ex.: 2023-13-45T99:99:99)
+        log.warning("Consulta rejeitada pelo OpenSearch: %s", e)
+        raise HTTPException(status_code=400, detail=f"Parâmetros inválidos: {str(e)}")
     except Exception as e:
-        logging.error(f"Erro ao consultar OpenSearch: {str(e)}")
+        log.error("Erro ao consultar OpenSearch: %s", e)
         raise HTTPException(status_code=500, detail=f"Erro ao consultar OpenSearch: {str(e)}")
 
 # Endpoint to query a deviation by ID
@@ -294,20 +699,65 @@ def get_deviations(
         "timestamp": "2023-10-01T12:34:56"
         }
         ```
-        """)
-def get_deviation_by_id(
-    deviation_id: str,
-    opensearch_client: OpenSearch = Depends(get_opensearch_client)
+        """,
+        responses={
+            200: {"description": "Desvio encontrado"},
+            404: {"description": "Desvio não encontrado"},
+            422: {"description": "ID inválido"},
+            500: {"description": "Erro ao consultar o OpenSearch"}
+        })
+async def get_deviation_by_id(
+    # IDs inválidos são rejeitados pelo FastAPI (422) sem consultar o OpenSearch
+    deviation_id: str = PathParam(..., description="ID do desvio", pattern=r"^[A-Za-z0-9_-]{1,64}$"),
+    opensearch_client: AsyncOpenSearch = Depends(get_opensearch_client)
 ):
     try:
-        response = opensearch_client.get(
-            index="deviations",
-            id=deviation_id
-        )
-        return response["_source"]
-    except Exception as e:
-        logging.error(f"Desvio não encontrado: {str(e)}")
+        return await _cached_get(opensearch_client, deviation_id)
+    except NotFoundError as e:
+        log.error("Desvio não encontrado: %s", e)
         raise HTTPException(status_code=404, detail=f"Desvio não encontrado: {str(e)}")
+    except Exception as e:
+        log.error("Erro ao consultar OpenSearch: %s", e)
+        raise HTTPException(status_code=500, detail=f"Erro ao consultar OpenSearch: {str(e)}")
+
+# Status do cluster em cache por alguns segundos, para não sobrecarregar o OpenSearch com probes.
+# Falhas também ficam em cache: durante uma indisponibilidade, os probes recebem 503 imediatamente
+_HEALTH_TTL = 3
+# Tempo máximo (segundos) de espera pelo OpenSearch em cada verificação, já incluindo retries
+_HEALTH_TIMEOUT = 1
+_health_cache: Dict[str, Any] = {"ts": 0.0, "val": None, "error": None}
+_health_lock = asyncio.Lock()
+
+def _health_from_cache() -> Optional[str]:
+    if time.monotonic() - _health_cache["ts"] >= _HEALTH_TTL:
+        return None
+    if _health_cache["error"] is not None:
+        raise _health_cache["error"]
+    return _health_cache["val"]
+
+async def _cached_cluster_status(opensearch_client: AsyncOpenSearch) -> str:
+    status = _health_from_cache()
+    if status is not None:
+        return status
+    async with _health_lock:
+        # Outra requisição pode ter atualizado o cache enquanto aguardávamos o lock
+        status = _health_from_cache()
+        if status is not None:
+            return status
+        try:
+            # request_timeout limita cada tentativa no cliente; wait_for limita o total,
+            # impedindo que os retries do transporte prolonguem o probe
+            health = await asyncio.wait_for(
+                opensearch_client.cluster.health(local=True, request_timeout=_HEALTH_TIMEOUT, filter_path=["status"]),
+                timeout=_HEALTH_TIMEOUT
+            )
+            _health_cache["val"], _health_cache["error"] = health["status"], None
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                e = TimeoutError(f"OpenSearch não respondeu em {_HEALTH_TIMEOUT}s")
+            _health_cache["val"], _health_cache["error"] = None, e
+        _health_cache["ts"] = time.monotonic()
+        return _health_from_cache()
 
 # Endpoint to check the health of the API
 @app.get(   "/health",
@@ -316,6 +766,7 @@ def get_deviation_by_id(
             **Verifica o status da API e do cluster OpenSearch.**
 
             Este endpoint é útil para monitorar a disponibilidade da API e do banco de dados.
+            O status do cluster é mantido em cache por alguns segundos.
 
             ### Exemplo de Resposta:
             ```json
@@ -326,57 +777,156 @@ def get_deviation_by_id(
             }
             ```
             """)
-def health_check(opensearch_client: OpenSearch = Depends(get_opensearch_client)):
+@app.get(   "/health/ready",
+            summary="Readiness probe",
+            description="""
+            **Verifica se a API está pronta para receber requisições (inclui o OpenSearch).**
+
+            Mesma resposta de `/health`; indicado para o readinessProbe do Kubernetes.
+            """)
+async def health_check(opensearch_client: AsyncOpenSearch = Depends(get_opensearch_client)):
     try:
-        health = opensearch_client.cluster.health()
         return {
             "status": "healthy",
-            "opensearch_status": health["status"],
+            "opensearch_status": await _cached_cluster_status(opensearch_client),
             "version": app.version
         }
     except Exception as e:
-        logging.error(f"Serviço indisponível: {str(e)}")
+        log.error("Serviço indisponível: %s", e)
         raise HTTPException(status_code=503, detail=f"Serviço indisponível: {str(e)}")
 
+# Endpoint to check that the API process is alive
+@app.get(   "/health/live",
+            summary="Liveness probe",
+            description="""
+            **Verifica apenas se o processo da API está respondendo, sem consultar o OpenSearch.**
+
+            Indicado para o livenessProbe do Kubernetes.
+            """)
+async def liveness_check():
+    return {"status": "alive", "version": app.version}
+
+# Endpoint to flush the result cache (administrativo, protegido por token)
+_CACHE_FLUSH_TOKEN = os.getenv("CACHE_FLUSH_TOKEN")
+
+@app.post("/cache/flush",
+        summary="Limpar cache de resultados (melhor esforço)",
+        description="""
+        **Descarta os resultados de consultas mantidos em cache no worker que atender a requisição.**
+
+        Requer o cabeçalho `X-Admin-Token` igual à variável de ambiente `CACHE_FLUSH_TOKEN`;
+        sem essa variável configurada, o endpoint fica desabilitado.
+
+        É uma operação de melhor esforço: o cache é mantido em memória por processo e, com vários
+        workers, os demais continuam servindo seus resultados até expirarem (no máximo 60 segundos).
+        A resposta informa o `pid` do worker que foi limpo.
+        """,
+        responses={
+            200: {"description": "Cache do worker descartado"},
+            403: {"description": "Token ausente, inválido ou endpoint desabilitado"}
+        })
+async def flush_cache(x_admin_token: Optional[str] = Header(None)):
+    if not _CACHE_FLUSH_TOKEN or not x_admin_token or not hmac.compare_digest(x_admin_token, _CACHE_FLUSH_TOKEN):
+        raise HTTPException(status_code=403, detail="Acesso negado")
+    _search_cache.clear()
+    _get_cache.clear()
+    return {"status": "flushed", "scope": "process", "pid": os.getpid()}
+
 # Configuração do túnel Ngrok
+# O ngrok roda como um processo separado, iniciado uma única vez pelo processo principal,
+# para não bloquear o startup nem ser duplicado por cada worker
+_NGROK_API_URL = "http://127.0.0.1:4040/api/tunnels"
+_NGROK_CONFIRM_TIMEOUT = 30
+
+def _confirm_ngrok_tunnel(process, port):
+    # Executado em uma thread: consulta a API local do ngrok até o túnel aparecer,
+    # sem atrasar o início do servidor
+    deadline = time.monotonic() + _NGROK_CONFIRM_TIMEOUT
+    while time.monotonic() < deadline:
+        returncode = process.poll()
+        if returncode is not None:
+            log.error("Ngrok encerrou (código %s). Veja o log do ngrok. A API só estará disponível localmente.", returncode)
+            return
+        try:
+            with urllib.request.urlopen(_NGROK_API_URL, timeout=1) as response:
+                tunnels = orjson.loads(response.read()).get("tunnels", [])
+        except (OSError, ValueError):
+            tunnels = []
+        for tunnel in tunnels:
+            if tunnel.get("config", {}).get("addr", "").endswith(f":{port}") and tunnel.get("public_url"):
+                public_url = tunnel["public_url"]
+                log.info("Ngrok tunnel ativo! API disponível externamente em: %s", public_url)
+                log.info("Documentação disponível em: %s/docs", public_url)
+                return
+        time.sleep(0.5)
+    log.warning("Túnel do Ngrok não confirmado em %ss. A API pode estar disponível apenas localmente.", _NGROK_CONFIRM_TIMEOUT)
+
 def setup_ngrok(port):
-    if not ngrok_available:
-        logging.warning("Ngrok não está disponível. Certifique-se de que o pyngrok está instalado.")
+    ngrok_bin = shutil.which("ngrok")
+    if ngrok_bin is None:
+        log.warning("Ngrok não está disponível. Certifique-se de que o binário ngrok está instalado e no PATH.")
         return None
     
     try:
         # Obter token do Ngrok do .env (opcional)
+        env = dict(os.environ)
         ngrok_token = os.getenv("NGROK_AUTH_TOKEN")
         if ngrok_token:
-            ngrok.set_auth_token(ngrok_token)
+            env["NGROK_AUTHTOKEN"] = ngrok_token
         
-        # Iniciar um túnel HTTP para a porta especificada usando o domínio fixo
-        public_url = ngrok.connect(port, proto="http", domain="elephant-moved-informally.ngrok-free.app")
-        logging.info(f"Ngrok tunnel ativo! URL pública: {public_url}")
-        return public_url
+        # Iniciar um túnel HTTP para a porta especificada usando o domínio configurado
+        domain = os.getenv("NGROK_DOMAIN", "elephant-moved-informally.ngrok-free.app")
+        # O log do ngrok vai para o stderr herdado, junto com o log da API
+        process = subprocess.Popen(
+            [ngrok_bin, "http", str(port), f"--domain={domain}", "--log=stderr"],
+            env=env,
+            stdout=subprocess.DEVNULL
+        )
+        log.info("Ngrok iniciado (pid %s); aguardando confirmação do túnel", process.pid)
+
+        threading.Thread(target=_confirm_ngrok_tunnel, args=(process, port), daemon=True).start()
+        return process
     except Exception as e:
-        logging.error(f"Erro ao iniciar o Ngrok: {str(e)}")
+        log.error("Erro ao iniciar o Ngrok: %s", e)
         return None
 
 # Start the FastAPI server
+# Em produção, prefira o Gunicorn com workers do Uvicorn:
+#   gunicorn main:app -k uvicorn.workers.UvicornWorker -w $((2*$(nproc)+1)) -b 0.0.0.0:8000 --keep-alive 15
+# Cada worker cria o seu próprio cliente OpenSearch no evento de startup.
+async def _run_enable_concurrent_segment_search():
+    client = _make_opensearch_client()
+    try:
+        await _enable_concurrent_segment_search(client)
+    finally:
+        await client.close()
+
 if __name__ == "__main__":
+    # Passo administrativo único, fora do servidor
+    if sys.argv[1:] == ["enable-concurrent-segment-search"]:
+        asyncio.run(_run_enable_concurrent_segment_search())
+        sys.exit(0)
+
     import uvicorn
     
     # Configuração do servidor
     host = "0.0.0.0"
     port = 8000
+    # API limitada por I/O: 2 * CPUs + 1 workers por padrão
+    workers = int(os.getenv("WEB_CONCURRENCY", 2 * (os.cpu_count() or 1) + 1))
     
-    # Configurar Ngrok se estiver disponível
-    ngrok_url = None
-    if ngrok_available:
-        ngrok_url = setup_ngrok(port)
-        if ngrok_url:
-            logging.info(f"API disponível externamente em: {ngrok_url}")
-            logging.info(f"Documentação disponível em: {ngrok_url}/docs")
-        else:
-            logging.warning("Falha ao iniciar o Ngrok. A API só estará disponível localmente.")
+    # Configurar Ngrok apenas se habilitado (este bloco só roda no processo principal)
+    ngrok_process = None
+    if os.getenv("ENABLE_NGROK") == "1":
+        ngrok_process = setup_ngrok(port)
+        if ngrok_process is None:
+            log.warning("Falha ao iniciar o Ngrok. A API só estará disponível localmente.")
     
     # Iniciar o servidor
-    logging.info(f"Servidor iniciando em: http://{host}:{port}")
-    logging.info(f"Documentação disponível em: http://{host}:{port}/docs")
-    uvicorn.run(app, host=host, port=port)
+    log.info("Servidor iniciando em: http://%s:%s com %s workers", host, port, workers)
+    log.info("Documentação disponível em: http://%s:%s/docs", host, port)
+    try:
+        uvicorn.run("main:app", host=host, port=port, workers=workers, timeout_keep_alive=15)
+    finally:
+        if ngrok_process is not None:
+            ngrok_process.terminate()